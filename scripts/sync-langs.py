@@ -1,144 +1,368 @@
 #!/usr/bin/env python3
 """Sync arborium language features from crates.io.
 
-Fetches available lang-* features from arborium crate and updates:
+Fetches available lang-* features of the arborium crate from the crates.io
+sparse index and updates:
 - crates/plotnik-cli/Cargo.toml (features + optional Arborium dependencies)
-- crates/plotnik-cli/src/commands/language_registry.rs (definition consistency check)
+- crates/plotnik-cli/src/language_registry.rs (definition consistency check)
 
 Usage:
     python scripts/sync-langs.py [--version VERSION] [--dry-run]
 """
 
 import argparse
+import gzip
+import http.client
 import json
+import mmap
+import os
 import re
-import urllib.request
+import urllib.parse
+from collections import deque
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
+from typing import BinaryIO
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache"))
+CACHE_PATH = CACHE_DIR / "plotnik/sync-langs.json"
+
+USER_AGENT = "plotnik-sync-langs"
+
+# Keep-alive connections keyed by (scheme, host), reused across requests.
+CONNECTIONS: dict[tuple[str, str], http.client.HTTPConnection] = {}
+
+# (begin, end) marker lines around the generated sections of plotnik-cli/Cargo.toml.
+ALL_LANGUAGES_MARKERS = (b"# @generated:all-languages:begin", b"# @generated:all-languages:end")
+LANG_FEATURES_MARKERS = (b"# @generated:lang-features:begin", b"# @generated:lang-features:end")
+LANG_DEPS_MARKERS = (b"# @generated:lang-deps:begin", b"# @generated:lang-deps:end")
+
+# Matches `feature: "lang-foo",` entries of the language table.
+FEATURE_RE = re.compile(rb'^\s*feature:\s*"(lang-[^"]+)"', re.MULTILINE)
 
 
 def parse_builtin_langs(path: Path) -> set[str]:
     """Extract lang-* features defined in builtin.rs."""
-    content = path.read_text()
-    langs = set()
-    for line in content.splitlines():
-        line = line.strip()
-        if line.startswith("feature:"):
-            # feature: "lang-foo",
-            rest = line[len("feature:"):].strip()
-            if rest.startswith('"'):
-                rest = rest[1:]
-                if '"' in rest:
-                    lang = rest[:rest.index('"')]
-                    if lang.startswith("lang-"):
-                        langs.add(lang)
-    return langs
+    with open(path, "rb") as f:
+        # An empty file cannot be memory-mapped.
+        if os.fstat(f.fileno()).st_size == 0:
+            return set()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return {lang.decode() for lang in FEATURE_RE.findall(mm)}
+
+
+def _send(
+    key: tuple[str, str], method: str, path: str, headers: dict[str, str], body: bytes | None
+) -> http.client.HTTPResponse:
+    conn = CONNECTIONS.get(key)
+    if conn is None:
+        scheme, host = key
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(host, timeout=30)
+        else:
+            conn = http.client.HTTPConnection(host, timeout=30)
+        CONNECTIONS[key] = conn
+    conn.request(method, path, body=body, headers=headers)
+    return conn.getresponse()
+
+
+@contextmanager
+def http_request(
+    method: str, url: str, headers: dict[str, str] | None = None, body: bytes | None = None
+) -> Iterator[tuple[http.client.HTTPResponse, BinaryIO]]:
+    """Send a request over a pooled keep-alive connection.
+
+    Yields the response and its body stream, gunzipped if the server
+    compressed it. The body is drained on exit so the next request to the
+    same host can reuse the connection.
+    """
+    parts = urllib.parse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    headers = {"User-Agent": USER_AGENT, "Accept-Encoding": "gzip", **(headers or {})}
+
+    try:
+        try:
+            resp = _send(key, method, path, headers, body)
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # The server may have dropped an idle connection; reconnect once.
+            # Only idempotent requests are resent, since a POST may already
+            # have landed.
+            if method not in ("GET", "HEAD"):
+                raise
+            CONNECTIONS.pop(key).close()
+            resp = _send(key, method, path, headers, body)
+
+        if resp.getheader("Content-Encoding") == "gzip":
+            yield resp, gzip.GzipFile(fileobj=resp)
+        else:
+            yield resp, resp
+        resp.read()
+    except BaseException:
+        # Whatever failed, the connection may be mid-exchange; never reuse it.
+        conn = CONNECTIONS.pop(key, None)
+        if conn is not None:
+            conn.close()
+        raise
+
+
+def atomic_write(path: Path, data: bytes) -> None:
+    """Write `data` to a sibling temp file, then rename it over `path`.
+
+    A failed run never leaves `path` truncated or half-written.
+    """
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
 
 
-def fetch_lang_features(version: str | None) -> tuple[str, list[str]]:
-    """Fetch lang-* features from crates.io API."""
-    url = "https://crates.io/api/v1/crates/arborium"
-    req = urllib.request.Request(url, headers={"User-Agent": "plotnik-sync-langs"})
-    with urllib.request.urlopen(req) as resp:
-        data = json.load(resp)
-
-    versions = data["versions"]
-    if version:
-        ver = next((v for v in versions if v["num"] == version), None)
-        if not ver:
-            available = [v["num"] for v in versions[:10]]
-            raise ValueError(f"Version {version} not found. Available: {available}")
+def load_cache(url: str) -> dict | None:
+    """Load the cached crates.io response for `url`, if any."""
+    try:
+        cache = json.loads(CACHE_PATH.read_bytes())
+    except (OSError, ValueError):
+        return None
+    if cache.get("url") != url or not cache.get("etag"):
+        return None
+    return cache
+
+
+def store_cache(url: str, etag: str, version: str, langs: list[str]) -> None:
+    """Persist the parsed crates.io response along with its ETag."""
+    cache = {"url": url, "etag": etag, "version": version, "langs": langs}
+    CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+    atomic_write(CACHE_PATH, json.dumps(cache).encode())
+
+
+def sparse_index_url(crate: str) -> str:
+    """Build the crates.io sparse index URL for `crate`.
+
+    Follows Cargo's index sharding: 1- and 2-letter names live under `1/` and
+    `2/`, 3-letter names under `3/<first letter>/`, everything else under
+    `<first two>/<next two>/`.
+    """
+    name = crate.lower()
+    if len(name) <= 2:
+        prefix = str(len(name))
+    elif len(name) == 3:
+        prefix = f"3/{name[0]}"
     else:
-        ver = versions[0]
+        prefix = f"{name[:2]}/{name[2:4]}"
+    return f"https://index.crates.io/{prefix}/{name}"
+
 
-    features = ver["features"]
+def find_index_entry(lines: Iterable[bytes], version: str | None) -> dict:
+    """Pick the entry for `version` from sparse index lines.
+
+    Without `version`, picks the last published entry that isn't yanked (publish
+    order, not the highest semver). Lines are consumed as they stream in and
+    only the selected one is decoded. Apart from it, just the last few raw
+    lines are kept, for error reporting.
+    """
+    needle = f'"vers":"{version}"'.encode() if version else None
+    recent = deque(maxlen=10)
+    latest = None
+    for line in lines:
+        if not line.strip():
+            continue
+        if not needle and b'"yanked":true' not in line:
+            latest = line
+        if needle and needle in line:
+            entry = json.loads(line)
+            if entry["vers"] == version:
+                return entry
+        recent.append(line)
+
+    if not recent:
+        raise ValueError("No versions in sparse index for arborium")
+    if not version:
+        if latest is None:
+            raise ValueError("No unyanked versions in sparse index for arborium")
+        return json.loads(latest)
+    available = [json.loads(line)["vers"] for line in recent]
+    raise ValueError(f"Version {version} not found. Available: {available}")
+
+
+def fetch_lang_features(version: str | None) -> tuple[str, list[str]]:
+    """Fetch lang-* features from the crates.io sparse index.
+
+    The index file holds one JSON object per published version, oldest first,
+    so only the line we need is parsed. The result is cached on disk together
+    with the response ETag, so repeat runs only revalidate it and skip the
+    download when nothing changed.
+    """
+    url = sparse_index_url("arborium")
+
+    cache = load_cache(url)
+    if cache and version and cache["version"] != version:
+        cache = None
+    headers = {"If-None-Match": cache["etag"]} if cache else {}
+
+    with http_request("GET", url, headers) as (resp, body):
+        if resp.status == 304 and cache:
+            return cache["version"], cache["langs"]
+        if resp.status != 200:
+            raise http.client.HTTPException(f"GET {url}: {resp.status} {resp.reason}")
+        etag = resp.getheader("ETag")
+        ver = find_index_entry(body, version)
+
+    # Features using `dep:` syntax are published separately in `features2`.
+    features = {**ver["features"], **ver.get("features2", {})}
     langs = sorted(k for k in features if k.startswith("lang-"))
-    return ver["num"], langs
-
-
-def replace_section(content: str, start_marker: str, end_marker: str, new_content: str) -> str:
-    """Replace content between markers (exclusive of markers)."""
-    pattern = rf"({re.escape(start_marker)}\n).*?(\n{re.escape(end_marker)})"
-    replacement = rf"\g<1>{new_content}\g<2>"
-    result, count = re.subn(pattern, replacement, content, flags=re.DOTALL)
-    if count == 0:
-        raise ValueError(f"Markers not found: {start_marker!r} ... {end_marker!r}")
-    return result
-
-
-def update_plotnik_cli(path: Path, version: str, langs: list[str], dry_run: bool) -> bool:
-    """Update plotnik-cli/Cargo.toml."""
-    content = path.read_text()
-    original = content
-
-    # Generate all-languages array
-    all_langs_items = "\n".join(f'    "{lang}",' for lang in langs)
-    content = replace_section(
-        content,
-        "# @generated:all-languages:begin",
-        "# @generated:all-languages:end",
-        all_langs_items,
-    )
+    if etag and not version:
+        store_cache(url, etag, ver["vers"], langs)
+    return ver["vers"], langs
 
-    # Generate individual features.
-    features = "\n".join(f'{lang} = ["dep:arborium-{lang[5:]}"]' for lang in langs)
-    content = replace_section(
-        content,
-        "# @generated:lang-features:begin",
-        "# @generated:lang-features:end",
-        features,
-    )
 
-    # Generate optional Arborium dependencies.
-    deps = "\n".join(
-        f'arborium-{lang[5:]} = {{ version = "{version}", optional = true }}'
-        for lang in langs
-    )
-    content = replace_section(
-        content,
-        "# @generated:lang-deps:begin",
-        "# @generated:lang-deps:end",
-        deps,
-    )
+def replace_sections(
+    content: bytes, substitutions: dict[bytes, tuple[bytes, bytes]]
+) -> tuple[bytes, bool]:
+    """Replace content between markers (exclusive of markers) in one pass.
+
+    `substitutions` maps each start marker to its end marker and the new
+    content of the section. Markers must occupy whole lines.
 
-    if content == original:
+    Returns the new content and whether any section actually changed.
+    """
+    out = []
+    pending = set(substitutions)
+    open_marker = None
+    old_block = []
+    changed = False
+    for line in content.splitlines(keepends=True):
+        marker = line.rstrip(b"\n")
+        if open_marker is None:
+            out.append(line)
+            if marker in pending:
+                pending.remove(marker)
+                open_marker = marker
+            continue
+
+        end_marker, new_content = substitutions[open_marker]
+        if marker != end_marker:
+            old_block.append(line)
+            continue
+        new_block = new_content + b"\n"
+        changed |= b"".join(old_block) != new_block
+        out.append(new_block)
+        out.append(line)
+        old_block.clear()
+        open_marker = None
+
+    if open_marker is not None or pending:
+        start_marker = open_marker or min(pending)
+        end_marker, _ = substitutions[start_marker]
+        raise ValueError(
+            f"Markers not found: {start_marker.decode()!r} ... {end_marker.decode()!r}"
+        )
+    return b"".join(out), changed
+
+
+def cli_toml_sections(version: str, langs: list[str]) -> list[tuple[bytes, bytes, bytes]]:
+    """Generated sections of plotnik-cli/Cargo.toml as (start, end, content)."""
+    # Build the all-languages array, individual features, and optional
+    # Arborium dependencies in one pass over `langs`.
+    all_langs_items, features, deps = [], [], []
+    dep_spec = f'{{ version = "{version}", optional = true }}'
+    for lang in langs:
+        suffix = lang[5:]
+        all_langs_items.append(f'    "{lang}",')
+        features.append(f'{lang} = ["dep:arborium-{suffix}"]')
+        deps.append(f"arborium-{suffix} = {dep_spec}")
+
+    return [
+        (*ALL_LANGUAGES_MARKERS, "\n".join(all_langs_items).encode("ascii")),
+        (*LANG_FEATURES_MARKERS, "\n".join(features).encode("ascii")),
+        (*LANG_DEPS_MARKERS, "\n".join(deps).encode("ascii")),
+    ]
+
+
+def update_toml(
+    path: Path, content: bytes, sections: list[tuple[bytes, bytes, bytes]], dry_run: bool
+) -> bool:
+    """Rewrite the generated (start, end, content) sections of a TOML file.
+
+    `content` holds the current bytes of `path`, read by the caller.
+    """
+    substitutions = {start: (end, new_content) for start, end, new_content in sections}
+    content, changed = replace_sections(content, substitutions)
+
+    if not changed:
         print(f"  {path}: no changes")
         return False
 
     if dry_run:
         print(f"  {path}: would update")
     else:
-        path.write_text(content)
+        atomic_write(path, content)
         print(f"  {path}: updated")
     return True
 
 
-def check_builtin_consistency(builtin_path: Path, langs: list[str]) -> tuple[list[str], list[str]]:
+def check_builtin_consistency(defined: set[str], langs: list[str]) -> tuple[list[str], list[str]]:
     """Check if builtin.rs defines all langs from crates.io.
 
+    `defined` holds the langs parsed from builtin.rs by `parse_builtin_langs`.
+
     Returns (added, removed) where:
     - added: langs new in arborium, need to add to builtin.rs
     - removed: langs removed from arborium, need to delete from builtin.rs
     """
-    defined = parse_builtin_langs(builtin_path)
-    expected = set(langs)
+    expected = frozenset(langs)
 
-    added = sorted(expected - defined)
+    # `langs` is already sorted, so filtering it keeps `added` in order.
+    added = [lang for lang in langs if lang not in defined]
     removed = sorted(defined - expected)
     return added, removed
 
 
+def github_api(method: str, path: str, payload: dict | None = None):
+    """Call the GitHub REST API with the Actions token and decode the JSON reply."""
+    url = os.environ.get("GITHUB_API_URL", "https://api.github.com") + path
+    headers = {
+        "Authorization": f"Bearer {os.environ['GITHUB_TOKEN']}",
+        "Accept": "application/vnd.github+json",
+    }
+    data = None
+    if payload is not None:
+        data = json.dumps(payload).encode()
+        headers["Content-Type"] = "application/json"
+
+    with http_request(method, url, headers, data) as (resp, body):
+        if resp.status >= 300:
+            raise http.client.HTTPException(f"{method} {url}: {resp.status} {resp.reason}")
+        return json.load(body)
+
+
+def current_pr_number(repo: str) -> int:
+    """Find the pull request the current GitHub Actions run belongs to."""
+    event = json.loads(Path(os.environ["GITHUB_EVENT_PATH"]).read_text())
+    if "pull_request" in event:
+        return event["pull_request"]["number"]
+
+    # Push-triggered runs (the Renovate branch sync) carry no PR, so look it
+    # up by the pushed branch.
+    owner = repo.split("/")[0]
+    branch = os.environ["GITHUB_REF_NAME"]
+    query = urllib.parse.urlencode({"head": f"{owner}:{branch}", "state": "open"})
+    pulls = github_api("GET", f"/repos/{repo}/pulls?{query}")
+    if not pulls:
+        raise ValueError(f"No open pull request for branch {branch}")
+    return pulls[0]["number"]
+
+
 def post_pr_comment(added: list[str], removed: list[str]) -> None:
     """Post a comment to the current PR about builtin.rs inconsistency."""
-    import subprocess
-
-    lines = ["Update `crates/plotnik-cli/src/commands/language_registry.rs`:", ""]
+    lines = ["Update `crates/plotnik-cli/src/language_registry.rs`:", ""]
     if added:
         lines.append("Add: " + ", ".join(f"`{lang}`" for lang in added))
     if removed:
         lines.append("Remove: " + ", ".join(f"`{lang}`" for lang in removed))
 
-    body = "\n".join(lines)
-    subprocess.run(["gh", "pr", "comment", "--body", body], check=True)
+    repo = os.environ["GITHUB_REPOSITORY"]
+    number = current_pr_number(repo)
+    github_api("POST", f"/repos/{repo}/issues/{number}/comments", {"body": "\n".join(lines)})
 
 
 def main():
@@ -148,20 +372,27 @@ def main():
     parser.add_argument("--ci", action="store_true", help="CI mode: post PR comment on mismatch")
     args = parser.parse_args()
 
-    version, langs = fetch_lang_features(args.version)
-    print(f"Found {len(langs)} languages in arborium {version}")
-
     root = Path(__file__).resolve().parent.parent
     cli_toml = root / "crates/plotnik-cli/Cargo.toml"
-    registry_rs = root / "crates/plotnik-cli/src/commands/language_registry.rs"
+    registry_rs = root / "crates/plotnik-cli/src/language_registry.rs"
+
+    # The local reads don't depend on the network fetch, so hide them behind it.
+    with ThreadPoolExecutor(max_workers=3) as pool:
+        fetched = pool.submit(fetch_lang_features, args.version)
+        defined = pool.submit(parse_builtin_langs, registry_rs)
+        cli_toml_content = pool.submit(cli_toml.read_bytes)
+        version, langs = fetched.result()
+    print(f"Found {len(langs)} languages in arborium {version}")
 
     changed = False
-    changed |= update_plotnik_cli(cli_toml, version, langs, args.dry_run)
+    changed |= update_toml(
+        cli_toml, cli_toml_content.result(), cli_toml_sections(version, langs), args.dry_run
+    )
 
     if args.dry_run and changed:
         print("\nRun without --dry-run to apply changes")
 
-    added, removed = check_builtin_consistency(registry_rs, langs)
+    added, removed = check_builtin_consistency(defined.result(), langs)
     if added or removed:
         print("\nlanguage_registry.rs is out of sync with arborium:")
         for lang in added: